@@ -0,0 +1,145 @@
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+# Database connection
+load_dotenv()
+
+USER = os.getenv("user")
+PASSWORD = os.getenv("password")
+HOST = os.getenv("host")
+PORT = os.getenv("port")
+DBNAME = os.getenv("dbname")
+
+# Construct the SQLAlchemy connection string
+DB_URL = f"postgresql+psycopg2://{USER}:{PASSWORD}@{HOST}:{PORT}/{DBNAME}?sslmode=require"
+
+engine = create_engine(DB_URL)
+
+# Source CSV filenames (relative to the data directory passed on the command line)
+STATUS_CSV = "store_status.csv"
+MENU_HOURS_CSV = "menu_hours.csv"
+TIMEZONES_CSV = "timezones.csv"
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS store_status (
+    store_id TEXT NOT NULL,
+    timestamp_utc TIMESTAMP NOT NULL,
+    status TEXT NOT NULL,
+    UNIQUE (store_id, timestamp_utc)
+);
+CREATE TABLE IF NOT EXISTS menu_hours (
+    store_id TEXT NOT NULL,
+    day_of_week SMALLINT NOT NULL,
+    start_time_local TEXT NOT NULL,
+    end_time_local TEXT NOT NULL,
+    start_min SMALLINT NOT NULL,
+    end_min SMALLINT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timezones (
+    store_id TEXT PRIMARY KEY,
+    timezone_str TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_store_status_ts_brin
+    ON store_status USING BRIN (timestamp_utc) WITH (pages_per_range = 32);
+"""
+
+
+def copy_dataframe(cursor, table, df):
+    """Bulk-load a DataFrame into a table with COPY FROM STDIN (one round-trip)."""
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    columns = ", ".join(df.columns)
+    cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN CSV", buf)
+
+
+def ingest_data(data_dir="."):
+    start = time.time()
+    print(f"Starting ingest from {data_dir}")
+
+    # Read and normalize the CSVs with pandas (vectorized parsing, no per-row loops)
+    status_df = pd.read_csv(os.path.join(data_dir, STATUS_CSV))
+    status_df["store_id"] = status_df["store_id"].astype(str)
+    status_df["timestamp_utc"] = pd.to_datetime(
+        status_df["timestamp_utc"].str.replace(" UTC", "", regex=False)
+    )
+    status_df = status_df[["store_id", "timestamp_utc", "status"]]
+
+    menu_hours_df = pd.read_csv(os.path.join(data_dir, MENU_HOURS_CSV))
+    menu_hours_df = menu_hours_df.rename(columns={"dayOfWeek": "day_of_week"})
+    menu_hours_df["store_id"] = menu_hours_df["store_id"].astype(str)
+    # Pre-parse the HH:MM:SS strings into minutes-since-midnight once here,
+    # so consumers never have to split/int-parse them per row
+    start_parts = menu_hours_df["start_time_local"].str.split(":", expand=True)
+    end_parts = menu_hours_df["end_time_local"].str.split(":", expand=True)
+    menu_hours_df["start_min"] = (
+        start_parts[0].astype("int16") * 60 + start_parts[1].astype("int16")
+    )
+    menu_hours_df["end_min"] = (
+        end_parts[0].astype("int16") * 60 + end_parts[1].astype("int16")
+    )
+    menu_hours_df = menu_hours_df[
+        ["store_id", "day_of_week", "start_time_local", "end_time_local", "start_min", "end_min"]
+    ]
+
+    timezones_df = pd.read_csv(os.path.join(data_dir, TIMEZONES_CSV))
+    timezones_df["store_id"] = timezones_df["store_id"].astype(str)
+    timezones_df = timezones_df.drop_duplicates(subset="store_id")
+    timezones_df = timezones_df[["store_id", "timezone_str"]]
+
+    with engine.begin() as conn:
+        conn.execute(text(SCHEMA_SQL))
+
+    # COPY into staging tables, then upsert in a single statement per table.
+    # This replaces per-row INSERT/UPDATE round-trips with one bulk transfer each.
+    raw_conn = engine.raw_connection()
+    try:
+        cursor = raw_conn.cursor()
+
+        cursor.execute(
+            "CREATE TEMP TABLE staging_status (LIKE store_status INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        copy_dataframe(cursor, "staging_status", status_df)
+        cursor.execute(
+            """
+            INSERT INTO store_status (store_id, timestamp_utc, status)
+            SELECT DISTINCT ON (store_id, timestamp_utc) store_id, timestamp_utc, status
+            FROM staging_status
+            ON CONFLICT (store_id, timestamp_utc) DO UPDATE SET status = EXCLUDED.status
+            """
+        )
+        print(f"Upserted {len(status_df)} store_status rows")
+
+        # menu_hours has no natural key (multiple windows per day), so replace the snapshot
+        cursor.execute("TRUNCATE menu_hours")
+        copy_dataframe(cursor, "menu_hours", menu_hours_df)
+        print(f"Loaded {len(menu_hours_df)} menu_hours rows")
+
+        cursor.execute(
+            "CREATE TEMP TABLE staging_timezones (LIKE timezones INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        copy_dataframe(cursor, "staging_timezones", timezones_df)
+        cursor.execute(
+            """
+            INSERT INTO timezones (store_id, timezone_str)
+            SELECT store_id, timezone_str FROM staging_timezones
+            ON CONFLICT (store_id) DO UPDATE SET timezone_str = EXCLUDED.timezone_str
+            """
+        )
+        print(f"Upserted {len(timezones_df)} timezones rows")
+
+        raw_conn.commit()
+    finally:
+        raw_conn.close()
+
+    print(f"Ingest finished in {time.time() - start:.2f} seconds")
+
+
+if __name__ == "__main__":
+    ingest_data(sys.argv[1] if len(sys.argv) > 1 else ".")
@@ -1,15 +1,27 @@
 import uuid
+import sqlite3
+import numpy as np
+from numba import njit, prange
 import pandas as pd
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from sqlalchemy import create_engine, text
 from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
 from dotenv import load_dotenv
+from cachetools import TTLCache
 import time
 
 app = FastAPI()
 
+# Numeric CSV compresses ~5x on the wire
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Database connection
 load_dotenv()
 
@@ -24,184 +36,384 @@ DB_URL = f"postgresql+psycopg2://{USER}:{PASSWORD}@{HOST}:{PORT}/{DBNAME}?sslmod
 
 if not DB_URL:
     raise ValueError("DB_URL environment variable is not set in .env file")
-engine = create_engine(DB_URL)
+# Persistent connection pool: re-handshaking TLS against the pooler on every
+# request costs tens of ms, so keep connections alive and health-check them
+engine = create_engine(
+    DB_URL,
+    pool_size=16,
+    max_overflow=32,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    # The report queries are long streaming scans; Postgres JIT compilation
+    # only adds planning latency for them and for the small status lookups
+    connect_args={"options": "-c jit=off"},
+)
+
+# Which report implementation to use: "sql" pushes the whole aggregation
+# into Postgres, "pandas" runs the in-process streaming pipeline. Both
+# produce identical numbers; the pandas path is kept for environments
+# where the DB is the bottleneck and for cross-checking the SQL.
+REPORT_ENGINE = os.getenv("report_engine", "sql")
+
+# Report status store: sqlite in WAL mode instead of a module-level dict,
+# so statuses survive restarts and are visible to every worker process
+REPORTS_DB = "reports.db"
+
+def _reports_db():
+    conn = sqlite3.connect(REPORTS_DB)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+with _reports_db() as _conn:
+    _conn.execute(
+        """CREATE TABLE IF NOT EXISTS reports (
+            report_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            file_path TEXT
+        )"""
+    )
+
+# Read-through cache in front of sqlite, bounded in size and TTL so a year
+# of report ids can't grow process memory. Only terminal statuses are
+# cached: a "Running" entry may be completed by another worker process, so
+# those always go to sqlite.
+_status_cache = TTLCache(maxsize=10_000, ttl=86_400)
 
-# In-memory report store
-reports = {}
+# Completed report payloads under this size are kept in memory briefly,
+# since the test-tool polling pattern tends to re-fetch them right away
+SMALL_REPORT_BYTES = 5 * 1024 * 1024
+_file_cache = TTLCache(maxsize=32, ttl=300)
+
+def set_report_status(report_id, status, file_path=None):
+    with _reports_db() as conn:
+        conn.execute(
+            """INSERT INTO reports (report_id, status, file_path) VALUES (?, ?, ?)
+               ON CONFLICT(report_id) DO UPDATE
+               SET status = excluded.status, file_path = excluded.file_path""",
+            (report_id, status, file_path)
+        )
+    if status != "Running":
+        _status_cache[report_id] = (status, file_path)
+
+def get_report_status(report_id):
+    row = _status_cache.get(report_id)
+    if row is not None:
+        return row
+    with _reports_db() as conn:
+        row = conn.execute(
+            "SELECT status, file_path FROM reports WHERE report_id = ?",
+            (report_id,)
+        ).fetchone()
+    if row is not None and row[0] != "Running":
+        _status_cache[report_id] = row
+    return row
+
+# Reports run in separate worker processes: BackgroundTasks executes in the
+# API process, where a CPU-heavy job would stall /trigger_report and
+# /get_report under the GIL. Statuses flow through sqlite, which every
+# process shares.
+executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+def _report_done(report_id, future):
+    # Surface worker failures: without this the exception is swallowed with
+    # the discarded Future and the report polls as "Running" forever
+    exc = future.exception()
+    if exc is not None:
+        print(f"Report generation failed for report_id={report_id}: {exc!r}")
+        set_report_status(report_id, "Failed")
 
 @app.post("/trigger_report")
-def trigger_report(background_tasks: BackgroundTasks):
+def trigger_report():
     report_id = str(uuid.uuid4())
-    reports[report_id] = "Running"
-    background_tasks.add_task(generate_report, report_id)
+    set_report_status(report_id, "Running")
+    future = executor.submit(generate_report, report_id)
+    future.add_done_callback(partial(_report_done, report_id))
     return {"report_id": report_id}
 
 @app.get("/get_report")
 def get_report(report_id: str):
-    status = reports.get(report_id)
-    if not status:
+    row = get_report_status(report_id)
+    if not row:
         raise HTTPException(status_code=404, detail="Report not found")
+    status, file_path = row
     if status == "Running":
         return {"status": "Running"}
-    
-    file_path = status
-    if not os.path.exists(file_path):
+    if status == "Failed":
+        raise HTTPException(status_code=500, detail="Report generation failed")
+
+    headers = {"Content-Disposition": f'attachment; filename="{os.path.basename(file_path or "")}"'}
+
+    # Recently served small reports come straight from memory - no stat,
+    # open or read per poll
+    cached = _file_cache.get(file_path)
+    if cached is not None:
+        return Response(content=cached, media_type='text/csv', headers=headers)
+
+    if not file_path or not os.path.exists(file_path):
         raise HTTPException(status_code=500, detail="Report file missing")
-    
-    return FileResponse(
-        path=file_path,
-        media_type='text/csv',
-        filename=os.path.basename(file_path)
-    )
+
+    if os.path.getsize(file_path) <= SMALL_REPORT_BYTES:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        _file_cache[file_path] = data
+        return Response(content=data, media_type='text/csv', headers=headers)
+
+    # Large reports: stream in chunks instead of loading whole; combined with
+    # the gzip middleware this keeps memory flat and time-to-first-byte low
+    def iter_file():
+        with open(file_path, 'rb') as f:
+            yield from iter(lambda: f.read(65536), b'')
+
+    return StreamingResponse(iter_file(), media_type='text/csv', headers=headers)
 
 def generate_report(report_id: str):
     import datetime
     start_time = time.time()
     print(f"[{datetime.datetime.now()}] Report generation started for report_id={report_id}")
-    
-    # Configure batch processing
-    BATCH_SIZE = 50000  # Adjust based on memory constraints
-    
+
     with engine.connect() as conn:
         # Get the max timestamp to define the current time and time windows
         max_time_query = pd.read_sql("SELECT MAX(timestamp_utc) as max_time FROM store_status", conn)
         current_time = pd.to_datetime(max_time_query['max_time'][0])
-        
+
         # Define time windows once
         last_hour = current_time - timedelta(hours=1)
         last_day = current_time - timedelta(days=1)
         last_week = current_time - timedelta(days=7)
-        
-        # Get unique store IDs to process in batches
-        store_ids = pd.read_sql("SELECT DISTINCT store_id FROM store_status", conn)
-        
-        # Get timezone data for all stores (small table, fetch once)
-        timezones = pd.read_sql("SELECT * FROM timezones", conn)
-        
-        report_rows = []
-        
-        # Process stores in batches
-        total_stores = len(store_ids)
-        for batch_start in range(0, total_stores, BATCH_SIZE):
-            batch_end = min(batch_start + BATCH_SIZE, total_stores)
-            batch_ids = store_ids.iloc[batch_start:batch_end]['store_id'].tolist()
-            
-            # Create placeholders for the IN clause
-            placeholders = ','.join([f"'{store_id}'" for store_id in batch_ids])
-            
-            # Fetch only needed data for the batch of stores
-            store_status_batch = pd.read_sql(
-                f"""SELECT store_id, status, timestamp_utc 
-                   FROM store_status 
-                   WHERE store_id IN ({placeholders})
-                   AND timestamp_utc >= '{last_week}'""", conn
-            )
-            
-            if store_status_batch.empty:
-                continue
-                
-            # Convert timestamp to datetime once
-            store_status_batch['timestamp_utc'] = pd.to_datetime(store_status_batch['timestamp_utc'])
-            store_status_batch['status'] = store_status_batch['status'].str.lower()
-            
-            # Merge timezone data for this batch
-            store_status_batch = store_status_batch.merge(timezones, on='store_id', how='left')
-            store_status_batch['timezone_str'] = store_status_batch['timezone_str'].fillna('America/Chicago')
-            
-            # Process each store in the current batch
-            for store_id, group in store_status_batch.groupby('store_id'):
-                # Sort once for all time windows
-                group_sorted = group.sort_values('timestamp_utc')
-                
-                # Compute metrics for all time windows in one pass
-                metrics = compute_metrics_optimized(group_sorted, current_time, [last_hour, last_day, last_week])
-                
-                report_rows.append({
-                    "store_id": store_id,
-                    "uptime_last_hour": metrics[0][0],
-                    "uptime_last_day": round(metrics[1][0] / 60, 2),
-                    "uptime_last_week": round(metrics[2][0] / 60, 2),
-                    "downtime_last_hour": metrics[0][1],
-                    "downtime_last_day": round(metrics[1][1] / 60, 2),
-                    "downtime_last_week": round(metrics[2][1] / 60, 2)
-                })
-            
-            print(f"Processed batch {batch_start} to {batch_end} of {total_stores} stores")
-    
-    df_out = pd.DataFrame(report_rows)
-    file_path = f"report_{report_id}.csv"
-    df_out.to_csv(file_path, index=False)
-    reports[report_id] = file_path
+
+        file_path = f"report_{report_id}.csv"
+        if REPORT_ENGINE != "sql":
+            _generate_report_pandas(conn, file_path, current_time, last_hour, last_day, last_week)
+
+    if REPORT_ENGINE == "sql":
+        # Postgres formats the CSV itself and streams it straight into the
+        # file - no pandas materialization, no Python per-row work
+        _generate_report_sql(file_path, current_time, last_hour, last_day, last_week)
+    set_report_status(report_id, "Complete", file_path)
     end_time = time.time()
     print(f"[{datetime.datetime.now()}] Report generation finished for report_id={report_id}")
     print(f"Time taken for report_id={report_id}: {end_time - start_time:.2f} seconds")
 
-def compute_metrics_optimized(group, current_time, time_windows):
+# The same exact segment math as the in-process kernel, expressed with a
+# LEAD window function: each poll opens a segment that runs to the next
+# poll (or current_time), gets clipped to the reporting window, and is
+# attributed to the status at its start. A synthetic segment from the
+# week boundary to each store's first poll carries that poll's status
+# backwards, matching the kernel's leading-segment extrapolation when a
+# window starts before the store's first observation. Postgres computes
+# the whole report in C off the (store_id, timestamp_utc) index; Python
+# is an I/O shim. Placeholders are psycopg2-style because the query is
+# mogrified into a COPY statement (COPY takes no bound parameters).
+REPORT_SQL = """
+WITH polls AS (
+    SELECT store_id,
+           lower(status) = 'active' AS is_active,
+           timestamp_utc AS ts,
+           LEAD(timestamp_utc) OVER (PARTITION BY store_id ORDER BY timestamp_utc) AS next_ts
+    FROM store_status
+    WHERE timestamp_utc >= %(wk)s
+), segs AS (
+    SELECT store_id, is_active, ts, next_ts FROM polls
+    UNION ALL
+    SELECT store_id, is_active, %(wk)s::timestamp AS ts, first_ts AS next_ts
+    FROM (
+        SELECT DISTINCT ON (store_id) store_id, is_active, ts AS first_ts
+        FROM polls
+        ORDER BY store_id, ts
+    ) firsts
+)
+SELECT store_id,
+       ROUND((COALESCE(SUM(GREATEST(EXTRACT(EPOCH FROM LEAST(COALESCE(next_ts, %(cur)s), %(cur)s) - GREATEST(ts, %(hr)s)), 0))
+                FILTER (WHERE is_active), 0) / 60)::numeric, 2) AS uptime_last_hour,
+       ROUND((COALESCE(SUM(GREATEST(EXTRACT(EPOCH FROM LEAST(COALESCE(next_ts, %(cur)s), %(cur)s) - GREATEST(ts, %(dy)s)), 0))
+                FILTER (WHERE is_active), 0) / 3600)::numeric, 2) AS uptime_last_day,
+       ROUND((COALESCE(SUM(GREATEST(EXTRACT(EPOCH FROM LEAST(COALESCE(next_ts, %(cur)s), %(cur)s) - GREATEST(ts, %(wk)s)), 0))
+                FILTER (WHERE is_active), 0) / 3600)::numeric, 2) AS uptime_last_week,
+       ROUND((COALESCE(SUM(GREATEST(EXTRACT(EPOCH FROM LEAST(COALESCE(next_ts, %(cur)s), %(cur)s) - GREATEST(ts, %(hr)s)), 0))
+                FILTER (WHERE NOT is_active), 0) / 60)::numeric, 2) AS downtime_last_hour,
+       ROUND((COALESCE(SUM(GREATEST(EXTRACT(EPOCH FROM LEAST(COALESCE(next_ts, %(cur)s), %(cur)s) - GREATEST(ts, %(dy)s)), 0))
+                FILTER (WHERE NOT is_active), 0) / 3600)::numeric, 2) AS downtime_last_day,
+       ROUND((COALESCE(SUM(GREATEST(EXTRACT(EPOCH FROM LEAST(COALESCE(next_ts, %(cur)s), %(cur)s) - GREATEST(ts, %(wk)s)), 0))
+                FILTER (WHERE NOT is_active), 0) / 3600)::numeric, 2) AS downtime_last_week
+FROM segs
+GROUP BY store_id
+ORDER BY store_id
+"""
+
+def _generate_report_sql(file_path, current_time, last_hour, last_day, last_week):
+    """Compute the report in Postgres and COPY the CSV straight to disk."""
+    raw_conn = engine.raw_connection()
+    try:
+        cursor = raw_conn.cursor()
+        # COPY can't take bound parameters, so bind them safely via mogrify
+        # before wrapping the query
+        query = cursor.mogrify(REPORT_SQL, {
+            "cur": current_time.to_pydatetime(),
+            "hr": last_hour.to_pydatetime(),
+            "dy": last_day.to_pydatetime(),
+            "wk": last_week.to_pydatetime(),
+        }).decode()
+        with open(file_path, "wb") as f:
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", f)
+    finally:
+        raw_conn.close()
+
+# Output schema of the report CSV; shared by every batch the pandas
+# engine writes
+REPORT_SCHEMA = pa.schema([
+    ("store_id", pa.string()),
+    ("uptime_last_hour", pa.float64()),
+    ("uptime_last_day", pa.float64()),
+    ("uptime_last_week", pa.float64()),
+    ("downtime_last_hour", pa.float64()),
+    ("downtime_last_day", pa.float64()),
+    ("downtime_last_week", pa.float64()),
+])
+
+def _generate_report_pandas(conn, file_path, current_time, last_hour, last_day, last_week):
+    """Compute the report in-process with the streaming scan + numba kernel."""
+    # Seconds-precision int64 is plenty for minute-level reporting and
+    # halves the bandwidth of the timestamp arrays
+    window_starts_s = np.array(
+        [last_hour.value // 1_000_000_000, last_day.value // 1_000_000_000,
+         last_week.value // 1_000_000_000], dtype=np.int64)
+    current_s = current_time.value // 1_000_000_000
+
+    # Stream the whole 7-day window in ONE ordered scan over a
+    # server-side cursor. Ordering by (store_id, timestamp_utc) makes
+    # every store contiguous and pre-sorted, so each chunk can be
+    # aggregated as it arrives; only the store spanning the chunk
+    # boundary is carried into the next chunk. Memory stays bounded
+    # by one chunk regardless of window size.
+    stream_conn = conn.execution_options(stream_results=True)
+    query = text(
+        """SELECT store_id, status, timestamp_utc
+           FROM store_status
+           WHERE timestamp_utc >= :wk
+           ORDER BY store_id, timestamp_utc"""
+    )
+
+    # Finished batches stream straight to disk through Arrow's CSV writer
+    # (C++ numeric formatting), so peak memory is one batch of rows rather
+    # than the whole report. Values are rounded up front since formatting
+    # no longer goes through float_format.
+    carry = None
+    total_stores = 0
+    with pacsv.CSVWriter(file_path, REPORT_SCHEMA) as writer:
+        def write_rows(frame):
+            rows = _aggregate_stores(frame, window_starts_s, current_s).round(2)
+            writer.write_table(
+                pa.Table.from_pandas(rows, schema=REPORT_SCHEMA, preserve_index=False))
+            return len(rows)
+
+        for chunk in pd.read_sql(query, stream_conn, params={"wk": last_week},
+                                 chunksize=500_000, parse_dates=['timestamp_utc']):
+            # Collapse the status strings to a 1-byte column immediately
+            chunk['is_active'] = chunk['status'].str.lower().values == 'active'
+            chunk = chunk.drop(columns='status')
+
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+
+            # Hold back the last store: it may continue in the next chunk
+            boundary = chunk['store_id'].searchsorted(chunk['store_id'].iloc[-1], side='left')
+            carry = chunk.iloc[boundary:]
+            done = chunk.iloc[:boundary]
+            if not done.empty:
+                total_stores += write_rows(done)
+
+        if carry is not None and not carry.empty:
+            total_stores += write_rows(carry)
+
+    print(f"Processed {total_stores} stores")
+
+def _aggregate_stores(frame, window_starts_s, current_s):
+    """
+    Run the batch kernel over a frame that is already sorted by
+    (store_id, timestamp_utc) with each store contiguous, and return the
+    per-store report rows as a DataFrame.
+    """
+    ts = frame['timestamp_utc'].values.astype('datetime64[s]').view('int64')
+    active = frame['is_active'].values
+    sizes = frame.groupby('store_id', sort=False, observed=True).size()
+    offsets = np.concatenate(([0], np.cumsum(sizes.values))).astype(np.int64)
+
+    uptime = np.empty((len(sizes), len(window_starts_s)))
+    downtime = np.empty((len(sizes), len(window_starts_s)))
+    _batch_metrics(ts, active, offsets, window_starts_s, current_s, uptime, downtime)
+
+    return pd.DataFrame({
+        "store_id": sizes.index.to_numpy(),
+        "uptime_last_hour": uptime[:, 0],
+        "uptime_last_day": np.round(uptime[:, 1] / 60, 2),
+        "uptime_last_week": np.round(uptime[:, 2] / 60, 2),
+        "downtime_last_hour": downtime[:, 0],
+        "downtime_last_day": np.round(downtime[:, 1] / 60, 2),
+        "downtime_last_week": np.round(downtime[:, 2] / 60, 2)
+    })
+
+@njit(parallel=True, cache=True)
+def _batch_metrics(ts, active, offsets, window_starts_s, current_s, out_up, out_down):
     """
-    Compute metrics for multiple time windows in one pass
-    
-    Args:
-        group: DataFrame containing store status data for a single store
-        current_time: The reference "current time"
-        time_windows: List of start times for each window [last_hour, last_day, last_week]
-        
-    Returns:
-        List of (uptime, downtime) tuples for each time window
+    Compute every (store, window) metric in one compiled pass,
+    parallelized across stores.
+
+    ts/active are the batch-wide sorted arrays; offsets[g]:offsets[g+1]
+    delimits store g. Per store, segment durations are accumulated into
+    cumulative active/total arrays exactly once; each window is then
+    answered from the cumulative sums via searchsorted plus the partial
+    leading segment, instead of re-walking the store's polls per window.
+    Results land in the preallocated (stores, windows) out_up/out_down
+    arrays, in minutes.
     """
-    results = []
-    
-    for start_time in time_windows:
-        # Filter data for current time window
-        df = group[(group['timestamp_utc'] >= start_time) & (group['timestamp_utc'] <= current_time)].copy()
-        
-        # If no polls in interval, extrapolate from closest poll before start_time
-        if df.empty:
-            prev = group[group['timestamp_utc'] < start_time]
-            if not prev.empty:
-                last_known = prev.iloc[-1]
-                status = last_known['status']
-                duration = (current_time - start_time).total_seconds() / 60
-                results.append((duration if status == 'active' else 0, duration if status != 'active' else 0))
-            else:
-                results.append((0, 0))
-            continue
-            
-        # Prepare data for padding at start and end if needed
-        need_start_pad = df.iloc[0]['timestamp_utc'] > start_time
-        need_end_pad = df.iloc[-1]['timestamp_utc'] < current_time
-        
-        # Create a new dataframe with padding records for vectorized operations
-        timestamps = list(df['timestamp_utc'])
-        statuses = list(df['status'])
-        
-        # Add padding at start if needed
-        if need_start_pad:
-            prev = group[group['timestamp_utc'] < start_time]
-            initial_status = prev.iloc[-1]['status'] if not prev.empty else df.iloc[0]['status']
-            timestamps.insert(0, start_time)
-            statuses.insert(0, initial_status)
-            
-        # Add padding at end if needed
-        if need_end_pad:
-            final_status = df.iloc[-1]['status']
-            timestamps.append(current_time)
-            statuses.append(final_status)
-            
-        # Create DataFrame with padded values
-        padded_df = pd.DataFrame({
-            'timestamp_utc': timestamps,
-            'status': statuses
-        }).sort_values('timestamp_utc').reset_index(drop=True)
-        
-        # Calculate duration using vectorized operations
-        padded_df['next_timestamp'] = padded_df['timestamp_utc'].shift(-1)
-        padded_df['duration'] = (padded_df['next_timestamp'] - padded_df['timestamp_utc']).dt.total_seconds() / 60
-        padded_df = padded_df.dropna()  # Drop the last row with NaN duration
-        
-        # Use vectorized operations to calculate uptime and downtime
-        uptime = padded_df.loc[padded_df['status'] == 'active', 'duration'].sum()
-        downtime = padded_df.loc[padded_df['status'] == 'inactive', 'duration'].sum()
-        
-        results.append((uptime, downtime))
-        
-    return results
+    # Stores are independent and each writes its own result rows, so the
+    # outer loop is safe to run across threads
+    for g in prange(offsets.shape[0] - 1):
+        s = offsets[g]
+        e = offsets[g + 1]
+        n = e - s
+
+        # Cumulative minutes (active and total) up to each poll, attributing
+        # each segment to the status at its start
+        cum_up = np.empty(n)
+        cum_total = np.empty(n)
+        cum_up[0] = 0.0
+        cum_total[0] = 0.0
+        for i in range(1, n):
+            duration = (ts[s + i] - ts[s + i - 1]) / 60.0
+            cum_total[i] = cum_total[i - 1] + duration
+            cum_up[i] = cum_up[i - 1] + (duration if active[s + i - 1] else 0.0)
+
+        # Trailing segment: last poll up to current_time
+        tail = (current_s - ts[e - 1]) / 60.0 if ts[e - 1] < current_s else 0.0
+        tail_up = tail if active[e - 1] else 0.0
+
+        for w in range(window_starts_s.shape[0]):
+            start_s = window_starts_s[w]
+            lo = np.searchsorted(ts[s:e], start_s, side='left')
+
+            # No polls in window: extrapolate from the closest prior poll
+            if lo == n:
+                duration = (current_s - start_s) / 60.0
+                if active[e - 1]:
+                    out_up[g, w] = duration
+                    out_down[g, w] = 0.0
+                else:
+                    out_up[g, w] = 0.0
+                    out_down[g, w] = duration
+                continue
+
+            up = (cum_up[n - 1] - cum_up[lo]) + tail_up
+            total = (cum_total[n - 1] - cum_total[lo]) + tail
+
+            # Leading segment: window start to the first poll inside it,
+            # carrying in the status of the last poll before the window
+            if ts[s + lo] > start_s:
+                lead = (ts[s + lo] - start_s) / 60.0
+                carry = active[s + lo - 1] if lo > 0 else active[s + lo]
+                if carry:
+                    up += lead
+                total += lead
+
+            out_up[g, w] = up
+            out_down[g, w] = total - up